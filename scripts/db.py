@@ -0,0 +1,50 @@
+import os
+from functools import lru_cache
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL
+
+
+# -------------------------------------------------------------------
+# Configuration
+# -------------------------------------------------------------------
+
+load_dotenv()
+
+PG_CONFIG = {
+    "host": os.getenv("PG_HOST"),
+    "port": os.getenv("PG_PORT"),
+    "dbname": os.getenv("PG_DB"),
+    "user": os.getenv("PG_USER"),
+    "password": os.getenv("PG_PASSWORD")
+}
+
+
+# -------------------------------------------------------------------
+# Database Utilities
+# -------------------------------------------------------------------
+
+@lru_cache(maxsize=None)
+def get_sqlalchemy_engine():
+    """
+    Returns the process-wide SQLAlchemy engine shared by all pipeline scripts,
+    created on first use. Each script is single-threaded and holds at most one
+    connection at a time, so the pool keeps exactly one connection open and
+    reuses it across schema setup, reads, COPY and inserts.
+    """
+    url = URL.create(
+        drivername="postgresql+psycopg2",
+        username=PG_CONFIG["user"],
+        password=PG_CONFIG["password"],
+        host=PG_CONFIG["host"],
+        port=PG_CONFIG["port"],
+        database=PG_CONFIG["dbname"]
+    )
+    return create_engine(
+        url,
+        pool_size=1,
+        max_overflow=0,
+        pool_pre_ping=True,
+        pool_recycle=1800
+    )
@@ -2,17 +2,22 @@
 # Imports and Setup
 # -----------------------
 
-import requests
+import aiohttp
+import asyncio
+import backoff
 import os
 import pandas as pd
-import psycopg2
 import json
 import logging
+import time
+from collections import deque
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-import time
+from sqlalchemy import text
 from tqdm import tqdm
 
+from scripts.db import PG_CONFIG, get_sqlalchemy_engine
+
 # -----------------------
 # Configuration
 # -----------------------
@@ -43,62 +48,244 @@ WEATHER_PARAMS = [
 START_DATE = "2022-07-01"
 END_DATE = "2022-07-31"
 
-# Load PostgreSQL connection parameters
-PG_CONFIG = {
-    "host": os.getenv("PG_HOST"),
-    "port": os.getenv("PG_PORT"),
-    "dbname": os.getenv("PG_DB"),
-    "user": os.getenv("PG_USER"),
-    "password": os.getenv("PG_PASSWORD")
-}
+# Upper bound on in-flight API requests
+MAX_CONCURRENCY = 64
+
+# Attempts per batch request before giving up, with jittered exponential backoff
+FETCH_MAX_TRIES = 3
+
+# Errors treated as failed fetches: transport/HTTP errors, timeouts, malformed payloads
+FETCH_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ValueError)
+
+# Coordinate pairs per API request, keeps the query string well under URL limits
+CITIES_PER_REQUEST = 50
+
+# Open-Meteo free tier allows 600 calls per minute
+MAX_REQUESTS_PER_MINUTE = 600
+
+# Multiplicative decrease applied to concurrency when the API throttles us
+THROTTLE_BACKOFF_FACTOR = 0.5
+
+# Seconds an idle connection to the API host is kept open for reuse
+KEEPALIVE_TIMEOUT = 60
+
+# -----------------------
+# Rate Limiting
+# -----------------------
+
+class RateLimiter:
+    """
+    Sliding-window request limiter with AIMD concurrency control.
+    Pauses on Retry-After, halves concurrency when throttled and
+    grows it back by one slot per successful response.
+    """
+
+    def __init__(self, max_per_minute, max_concurrency):
+        self.max_per_minute = max_per_minute
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self.in_flight = 0
+        self.request_times = deque()
+        self.paused_until = 0.0
+        self.condition = asyncio.Condition()
+
+    async def wait_if_throttled(self, weight=1):
+        """
+        Block until a request slot is free within the window and concurrency limit.
+        Multi-location requests count as `weight` calls against the window.
+        """
+        while True:
+            async with self.condition:
+                now = time.monotonic()
+                while self.request_times and now - self.request_times[0] >= 60:
+                    self.request_times.popleft()
+
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.request_times and len(self.request_times) + weight > self.max_per_minute:
+                    wait = 60 - (now - self.request_times[0])
+                elif self.in_flight >= self.concurrency:
+                    await self.condition.wait()
+                    continue
+                else:
+                    self.request_times.extend([now] * weight)
+                    self.in_flight += 1
+                    return
+
+            await asyncio.sleep(wait)
+
+    def observe(self, response):
+        """Adjust pacing from the response status and rate-limit headers."""
+        headers = response.headers
+        throttled = response.status == 429
+
+        retry_after = headers.get("Retry-After")
+        if retry_after is not None:
+            throttled = True
+            try:
+                self.paused_until = max(self.paused_until, time.monotonic() + float(retry_after))
+            except ValueError:
+                logging.warning(f"Unparseable Retry-After header: {retry_after}")
+
+        for name, value in headers.items():
+            name = name.lower()
+            if not name.startswith("x-ratelimit-remaining"):
+                continue
+            limit = headers.get(name.replace("remaining", "limit"))
+            try:
+                if limit is not None and float(value) < 0.1 * float(limit):
+                    throttled = True
+            except ValueError:
+                continue
+
+        if throttled:
+            self.concurrency = max(1, int(self.concurrency * THROTTLE_BACKOFF_FACTOR))
+            logging.warning(f"API throttling detected, concurrency reduced to {self.concurrency}")
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
 
 # -----------------------
 # Weather API Fetch Logic
 # -----------------------
 
-def fetch_weather_for_city(city_info, retries=3, delay=2):
+def log_fetch_retry(details):
+    """Log a failed batch attempt before backoff sleeps and retries it."""
+    city_batch = details["args"][2]
+    logging.warning(
+        f"[Attempt {details['tries']}] Failed for {len(city_batch)} cities "
+        f"starting with {city_batch[0]['city']}: {details['exception']}"
+    )
+
+
+def is_permanent_error(e):
+    """Client errors other than 429 (e.g. 400 for bad coordinates) will not succeed on retry."""
+    return isinstance(e, aiohttp.ClientResponseError) and 400 <= e.status < 500 and e.status != 429
+
+
+@backoff.on_exception(
+    backoff.expo,
+    FETCH_ERRORS,
+    max_tries=FETCH_MAX_TRIES,
+    factor=2,
+    max_value=30,
+    jitter=backoff.full_jitter,
+    giveup=is_permanent_error,
+    on_backoff=log_fetch_retry
+)
+async def fetch_weather_for_city_batch(session, limiter, city_batch):
     """
-    Fetch hourly weather data from Open-Meteo API for a single city.
-    Includes retry logic for transient failures.
+    Fetch hourly weather data from Open-Meteo API for a batch of cities in one request.
+    Transient failures are retried with jittered exponential backoff.
     """
     base_url = "https://archive-api.open-meteo.com/v1/archive"
     params = {
-        "latitude": city_info["latitude"],
-        "longitude": city_info["longitude"],
+        "latitude": ",".join(str(city_info["latitude"]) for city_info in city_batch),
+        "longitude": ",".join(str(city_info["longitude"]) for city_info in city_batch),
         "hourly": ",".join(WEATHER_PARAMS),
         "start_date": START_DATE,
         "end_date": END_DATE,
         "timezone": "auto"
     }
 
-    for attempt in range(retries):
-        try:
-            response = requests.get(base_url, params=params, timeout=10)
+    await limiter.wait_if_throttled(weight=len(city_batch))
+    try:
+        async with session.get(base_url, params=params) as response:
+            limiter.observe(response)
             response.raise_for_status()
-            data = response.json()
-
-            hourly_data = data.get("hourly", {})
-            time_series = hourly_data.get("time", [])
-            if not time_series:
-                raise ValueError("No hourly data received.")
+            data = await response.json()
+    finally:
+        await limiter.release()
+
+    # A single location returns one object, several return a list in request order
+    results = data if isinstance(data, list) else [data]
+    if len(results) != len(city_batch):
+        raise ValueError(f"Expected {len(city_batch)} locations, received {len(results)}.")
+
+    frames = []
+    for city_info, result in zip(city_batch, results):
+        hourly_data = result.get("hourly", {})
+        time_series = hourly_data.get("time", [])
+        if not time_series:
+            logging.warning(f"No hourly data received for {city_info['city']}. Skipping city.")
+            continue
+
+        # The API returns column-oriented arrays, so build the frame in one shot
+        df = pd.DataFrame({
+            "timestamp": time_series,
+            **{param: hourly_data.get(param) for param in WEATHER_PARAMS}
+        })
+        df.insert(0, "city", city_info["city"])
+        df.insert(1, "city_key", city_info["city_key"])
+        df.insert(2, "latitude", city_info["latitude"])
+        df.insert(3, "longitude", city_info["longitude"])
+        frames.append(df)
+
+    return frames
+
+
+async def fetch_weather_for_cities_individually(session, limiter, city_batch):
+    """
+    Fallback for a failed batch: fetch each city on its own so one bad
+    location only loses that city.
+    """
+    async def fetch_one(city_info):
+        try:
+            return await fetch_weather_for_city_batch(session, limiter, [city_info])
+        except FETCH_ERRORS as e:
+            logging.error(f"Final failure for {city_info['city']}: {e}")
+            return []
 
-            return [
-                {
-                    "city": city_info["city"],
-                    "latitude": city_info["latitude"],
-                    "longitude": city_info["longitude"],
-                    "timestamp": timestamp,
-                    **{param: hourly_data.get(param, [None])[i] for param in WEATHER_PARAMS}
-                }
-                for i, timestamp in enumerate(time_series)
-            ]
+    results = await asyncio.gather(*(fetch_one(city_info) for city_info in city_batch))
+    return [frame for city_weather in results for frame in city_weather]
 
-        except Exception as e:
-            logging.warning(f"[Attempt {attempt+1}] Failed for {city_info['city']}: {e}")
-            time.sleep(delay)
 
-    logging.error(f"Final failure for {city_info['city']}")
-    return []
+async def fetch_weather_for_cities(cities):
+    """
+    Fetch weather for all cities in batched requests, run concurrently over a single HTTP session.
+    """
+    limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_CONCURRENCY)
+    # All requests hit one host, so pool per host and keep sockets warm between batches
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENCY,
+        limit_per_host=MAX_CONCURRENCY,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=300
+    )
+    timeout = aiohttp.ClientTimeout(total=30)
+
+    batches = [
+        cities[i:i + CITIES_PER_REQUEST]
+        for i in range(0, len(cities), CITIES_PER_REQUEST)
+    ]
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        with tqdm(total=len(cities), desc="Fetching Weather Data") as progress:
+            async def fetch(city_batch):
+                try:
+                    batch_weather = await fetch_weather_for_city_batch(session, limiter, city_batch)
+                except FETCH_ERRORS as e:
+                    if len(city_batch) == 1:
+                        logging.error(f"Final failure for {city_batch[0]['city']}: {e}")
+                        batch_weather = []
+                    else:
+                        # One bad location fails the whole request, so isolate it city by city
+                        logging.warning(
+                            f"Batch of {len(city_batch)} cities failed ({e}); fetching cities individually."
+                        )
+                        batch_weather = await fetch_weather_for_cities_individually(
+                            session, limiter, city_batch
+                        )
+                progress.update(len(city_batch))
+                return batch_weather
+
+            results = await asyncio.gather(*(fetch(city_batch) for city_batch in batches))
+
+    return [frame for batch_weather in results for frame in batch_weather]
 
 # -----------------------
 # Database Access
@@ -107,34 +294,29 @@ def fetch_weather_for_city(city_info, retries=3, delay=2):
 def fetch_cities_from_db():
     """
     Connect to PostgreSQL and retrieve cities with latitude/longitude for weather querying.
+    Requires the city_key column from scripts/migrations/001_add_city_key.sql.
     """
     try:
-        conn = psycopg2.connect(**PG_CONFIG)
-        cursor = conn.cursor()
-
-        query = """
-            SELECT name, latitude, longitude
+        query = text("""
+            SELECT name, city_key, latitude, longitude
             FROM shipments.cities
             WHERE latitude IS NOT NULL AND longitude IS NOT NULL;
-        """
+        """)
 
-        cursor.execute(query)
-        results = cursor.fetchall()
+        with get_sqlalchemy_engine().connect() as conn:
+            results = conn.execute(query).fetchall()
 
         cities = [
-            {"city": row[0], "latitude": row[1], "longitude": row[2]}
+            {"city": row[0], "city_key": row[1], "latitude": row[2], "longitude": row[3]}
             for row in results
         ]
 
-        cursor.close()
-        conn.close()
-
         logging.info(f"Fetched {len(cities)} cities from database.")
         return cities
 
     except Exception as e:
         logging.error(f"Database connection or query failed: {e}")
-        return []
+        raise
 
 # -----------------------
 # Main Pipeline Function
@@ -142,32 +324,32 @@ def fetch_cities_from_db():
 
 def collect_and_store_weather_data():
     """
-    Main function to fetch weather data for all cities and save to CSV.
+    Main function to fetch weather data for all cities and save to Parquet.
     """
     cities = fetch_cities_from_db()
     if not cities:
         logging.warning("No cities to process. Exiting.")
         return
 
-    all_weather_records = []
-
-    for city in tqdm(cities, desc="Fetching Weather Data"):
-        city_weather = fetch_weather_for_city(city)
-        if city_weather:
-            all_weather_records.extend(city_weather)
+    frames = asyncio.run(fetch_weather_for_cities(cities))
 
-    if not all_weather_records:
+    if not frames:
         logging.warning("No weather data was collected.")
         return
 
-    df = pd.DataFrame(all_weather_records)
+    df = pd.concat(frames, ignore_index=True)
+    # Every city repeats the same hourly timestamps, so cached parsing pays off
+    df["timestamp"] = pd.to_datetime(df["timestamp"], format="%Y-%m-%dT%H:%M", cache=True)
+    df["city"] = df["city"].astype("category")
+    df["city_key"] = df["city_key"].astype("category")
 
     # Ensure output directory exists
     output_dir = "data/raw/weather/"
     os.makedirs(output_dir, exist_ok=True)
 
-    output_file = f"{output_dir}/weather_data_2022_07.csv"
-    df.to_csv(output_file, index=False)
+    # Parquet keeps column types, so downstream reads need no parsing
+    output_file = f"{output_dir}/weather_data_2022_07.parquet"
+    df.to_parquet(output_file, engine="pyarrow", compression="zstd", index=False)
     logging.info(f"Weather data saved to {output_file}")
 
 # -----------------------
@@ -1,9 +1,9 @@
 import os
 import logging
-import pandas as pd
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import URL
+from sqlalchemy import text
+
+from scripts.db import get_sqlalchemy_engine
 
 # --------------------------------------------------
 # Environment Setup
@@ -19,24 +19,19 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-PG_CONFIG = {
-    "host": os.getenv("PG_HOST"),
-    "port": os.getenv("PG_PORT"),
-    "dbname": os.getenv("PG_DB"),
-    "user": os.getenv("PG_USER"),
-    "password": os.getenv("PG_PASSWORD")
-}
-
-def get_sqlalchemy_engine():
-    url = URL.create(
-        drivername="postgresql+psycopg2",
-        username=PG_CONFIG["user"],
-        password=PG_CONFIG["password"],
-        host=PG_CONFIG["host"],
-        port=PG_CONFIG["port"],
-        database=PG_CONFIG["dbname"]
-    )
-    return create_engine(url)
+FACT_COLUMNS = [
+    "shipment_id",
+    "city_id",
+    "timestamp",
+    "fuel_consumed_liters",
+    "temperature_2m",
+    "windspeed_10m",
+    "precipitation",
+    "weathercode"
+]
+
+# Bytes read from the CSV per COPY write (psycopg2 defaults to 8 KiB)
+COPY_BUFFER_SIZE = 1024 * 1024
 
 # --------------------------------------------------
 # Load CSV into Database
@@ -70,21 +65,18 @@ def load_fact_table_to_postgres(csv_path):
             """))
             logging.info("Ensured table 'analytics.fact_shipments_weather' exists.")
 
-        # Load CSV into DataFrame
-        df = pd.read_csv(csv_path)
-        df['timestamp'] = pd.to_datetime(df['timestamp'])
-
-        df.to_sql(
-            "fact_shipments_weather",
-            con=engine,
-            schema="analytics",
-            if_exists="append",
-            index=False,
-            method="multi",
-            chunksize=1000
-        )
-
-        logging.info(f"Loaded {len(df)} rows into analytics.fact_shipments_weather")
+            # Stream the CSV straight into COPY inside the same transaction as the
+            # DDL, so a failed load leaves the fact table untouched
+            with conn.connection.cursor() as cur, open(csv_path, "rb") as f:
+                cur.copy_expert(
+                    f"COPY analytics.fact_shipments_weather ({', '.join(FACT_COLUMNS)}) "
+                    "FROM STDIN WITH CSV HEADER",
+                    f,
+                    size=COPY_BUFFER_SIZE
+                )
+                row_count = cur.rowcount
+
+        logging.info(f"Loaded {row_count} rows into analytics.fact_shipments_weather")
         print("Fact table loaded successfully.")
 
     except Exception as e:
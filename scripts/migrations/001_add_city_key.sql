@@ -0,0 +1,7 @@
+-- One-off migration: normalized join key on shipments.cities.
+-- Run once by the table owner before the pipeline:
+--   psql -h $PG_HOST -p $PG_PORT -U $PG_USER -d $PG_DB -f scripts/migrations/001_add_city_key.sql
+
+ALTER TABLE shipments.cities
+ADD COLUMN IF NOT EXISTS city_key TEXT
+GENERATED ALWAYS AS (lower(trim(name))) STORED;
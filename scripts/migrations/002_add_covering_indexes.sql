@@ -0,0 +1,24 @@
+-- One-off migration: covering indexes for the windowed shipments read and
+-- the city key joins. Requires 001_add_city_key.sql. Run with psql in its
+-- default autocommit mode, since CREATE INDEX CONCURRENTLY cannot run in a
+-- transaction block:
+--   psql -h $PG_HOST -p $PG_PORT -U $PG_USER -d $PG_DB -f scripts/migrations/002_add_covering_indexes.sql
+
+-- A failed concurrent build leaves an INVALID index behind under the same
+-- name, which IF NOT EXISTS would then skip; drop any such leftovers first.
+SELECT format('DROP INDEX CONCURRENTLY %s', i.indexrelid::regclass)
+FROM pg_index i
+WHERE i.indexrelid IN (
+        to_regclass('shipments.idx_shipments_start_ts'),
+        to_regclass('shipments.idx_cities_key')
+    )
+  AND NOT i.indisvalid
+\gexec
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_shipments_start_ts
+ON shipments.shipments (shipment_start_timestamp)
+INCLUDE (start_location, consumed_fuel, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_cities_key
+ON shipments.cities (city_key)
+INCLUDE (id, latitude, longitude);
@@ -1,13 +1,16 @@
+import io
 import os
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import pandas as pd
+import psycopg2
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.engine import URL
+from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
 
+from scripts.db import get_sqlalchemy_engine
+
 
 # -------------------------------------------------------------------
 # Configuration
@@ -22,63 +25,96 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-PG_CONFIG = {
-    "host": os.getenv("PG_HOST"),
-    "port": os.getenv("PG_PORT"),
-    "dbname": os.getenv("PG_DB"),
-    "user": os.getenv("PG_USER"),
-    "password": os.getenv("PG_PASSWORD")
-}
+WEATHER_PARQUET_PATH = "data/raw/weather/weather_data_2022_07.parquet"
+FACT_CSV_PATH = "data/processed/fact_shipments_weather.csv"
+
+# Shipment window covered by the weather extract (end date inclusive)
+START_DATE = "2022-07-01"
+END_DATE = "2022-07-31"
+END_DATE_EXCLUSIVE = (datetime.strptime(END_DATE, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+
+# Rows per shipments chunk streamed from the server-side cursor
+SHIPMENTS_CHUNK_SIZE = 100_000
 
-WEATHER_CSV_PATH = "data/raw/weather/weather_data_2022_07.csv"
+# "pandas" builds the fact CSV locally, "database" joins inside PostgreSQL
+FACT_JOIN_MODES = {"pandas", "database"}
+FACT_JOIN_MODE = os.getenv("FACT_JOIN_MODE", "pandas")
+
+STG_WEATHER_COLUMNS = [
+    "city_key",
+    "latitude",
+    "longitude",
+    "timestamp",
+    "temperature_2m",
+    "windspeed_10m",
+    "precipitation",
+    "weathercode"
+]
 
 
 # -------------------------------------------------------------------
 # Database Utilities
 # -------------------------------------------------------------------
 
-def get_sqlalchemy_engine():
-    """Creates and returns a SQLAlchemy engine."""
-    url = URL.create(
-        drivername="postgresql+psycopg2",
-        username=PG_CONFIG["user"],
-        password=PG_CONFIG["password"],
-        host=PG_CONFIG["host"],
-        port=PG_CONFIG["port"],
-        database=PG_CONFIG["dbname"]
-    )
-    return create_engine(url)
+def load_cities():
+    """Fetches city data from PostgreSQL."""
+    try:
+        engine = get_sqlalchemy_engine()
+        cities_df = pd.read_sql(
+            "SELECT id, city_key, latitude, longitude FROM shipments.cities",
+            con=engine
+        )
+        logging.info("Successfully loaded cities from database.")
+        return cities_df
+    except SQLAlchemyError as e:
+        logging.error(f"Database load error: {e}")
+        return pd.DataFrame()
 
 
-def load_shipments_and_cities():
-    """Fetches shipment and city data from PostgreSQL."""
+def iter_shipment_chunks(chunksize=SHIPMENTS_CHUNK_SIZE):
+    """
+    Streams shipment data from PostgreSQL in chunks through a server-side cursor,
+    so only one chunk is held in memory at a time.
+    """
     try:
         engine = get_sqlalchemy_engine()
-        shipments_df = pd.read_sql("SELECT * FROM shipments.shipments", con=engine)
-        cities_df = pd.read_sql("SELECT * FROM shipments.cities", con=engine)
-        logging.info("Successfully loaded shipments and cities from database.")
-        return shipments_df, cities_df
+        with engine.connect().execution_options(stream_results=True) as conn:
+            query = text("""
+                SELECT
+                    id,
+                    shipment_start_timestamp,
+                    lower(trim(start_location)) AS start_location_key,
+                    consumed_fuel
+                FROM shipments.shipments
+                WHERE shipment_start_timestamp >= :start_date
+                  AND shipment_start_timestamp < :end_date
+            """)
+            params = {"start_date": START_DATE, "end_date": END_DATE_EXCLUSIVE}
+            for chunk in pd.read_sql(query, con=conn, params=params, chunksize=chunksize):
+                yield chunk
+        logging.info("Successfully streamed shipments from database.")
     except SQLAlchemyError as e:
+        # Re-raise so a mid-stream failure never passes for a complete fact set
         logging.error(f"Database load error: {e}")
-        return pd.DataFrame(), pd.DataFrame()
+        raise
 
 
 # -------------------------------------------------------------------
 # File I/O
 # -------------------------------------------------------------------
 
-def load_weather_csv(filepath):
-    """Loads weather data from a CSV file."""
+def load_weather_parquet(filepath):
+    """Loads weather data from a Parquet file."""
     if not os.path.exists(filepath):
-        logging.error(f"Weather CSV not found: {filepath}")
+        logging.error(f"Weather Parquet file not found: {filepath}")
         return pd.DataFrame()
 
     try:
-        df = pd.read_csv(filepath)
+        df = pd.read_parquet(filepath, engine="pyarrow")
         logging.info(f"Loaded weather data: {len(df)} records.")
         return df
     except Exception as e:
-        logging.error(f"Error reading weather CSV: {e}")
+        logging.error(f"Error reading weather Parquet file: {e}")
         return pd.DataFrame()
 
 
@@ -86,46 +122,63 @@ def load_weather_csv(filepath):
 # Data Processing
 # -------------------------------------------------------------------
 
-def preprocess_and_join(shipments_df, cities_df, weather_df):
+def prepare_weather(cities_df, weather_df):
     """
-    Cleans and merges shipment, city, and weather data to form a fact table.
+    Indexes the weather data by city and hour for joining against shipment
+    chunks, and builds the city_key -> city id lookup.
     """
-    if shipments_df.empty or cities_df.empty or weather_df.empty:
-        logging.warning("One or more input datasets are empty.")
-        return pd.DataFrame()
+    if cities_df.empty or weather_df.empty:
+        logging.warning("City or weather dataset is empty.")
+        return pd.DataFrame(), pd.Series(dtype="int64")
 
-    cities_df["name"] = cities_df["name"].str.strip().str.lower()
-    weather_df["city"] = weather_df["city"].str.strip().str.lower()
+    # city_key is normalized in the database, not per run in pandas; sharing one
+    # categorical dtype turns the join into integer-code hash lookups
+    city_key_dtype = pd.CategoricalDtype(cities_df["city_key"].dropna().unique())
+    weather_df["city_key"] = weather_df["city_key"].astype(city_key_dtype)
+    # Keys outside the cities table become NaN (code -1), which the join would
+    # otherwise match against the last category; drop them before indexing
+    weather_df = weather_df[weather_df["city_key"].notna()].copy()
+    weather_df["weathercode"] = weather_df["weathercode"].astype("category")
+    weather_df["hourly_timestamp"] = weather_df["timestamp"].dt.floor("h")
 
-    merged_weather = pd.merge(
-        weather_df,
-        cities_df,
-        how="left",
-        left_on=["city", "latitude", "longitude"],
-        right_on=["name", "latitude", "longitude"]
-    )
+    # Index the smaller weather side so only one hash table is built for the join
+    weather_indexed = weather_df.set_index(
+        ["city_key", "hourly_timestamp"]
+    )[["temperature_2m", "windspeed_10m", "precipitation", "weathercode"]]
 
-    shipments_df["shipment_start_timestamp"] = pd.to_datetime(shipments_df["shipment_start_timestamp"])
-    shipments_df["hourly_timestamp"] = shipments_df["shipment_start_timestamp"].dt.floor("h")
-    shipments_df["city"] = shipments_df["start_location"].str.strip().str.lower()
+    city_to_id = cities_df.drop_duplicates("city_key").set_index("city_key")["id"]
+
+    logging.info(f"Prepared weather index: {len(weather_indexed)} records.")
+    return weather_indexed, city_to_id
+
+
+def join_shipments_with_weather(shipments_df, weather_indexed, city_to_id):
+    """
+    Joins a chunk of shipments against the prepared weather index to form fact rows.
+    """
+    if shipments_df.empty or weather_indexed.empty:
+        return pd.DataFrame()
 
-    merged_weather["timestamp"] = pd.to_datetime(merged_weather["timestamp"])
-    merged_weather["hourly_timestamp"] = merged_weather["timestamp"].dt.floor("h")
+    city_key_dtype = weather_indexed.index.get_level_values("city_key").dtype
+    shipments_df["start_location_key"] = shipments_df["start_location_key"].astype(city_key_dtype)
+    shipments_df = shipments_df[shipments_df["start_location_key"].notna()].copy()
+    # read_sql already returns the TIMESTAMP column as datetime64, so no parsing is needed
+    shipments_df["hourly_timestamp"] = shipments_df["shipment_start_timestamp"].dt.floor("h")
 
-    fact_df = pd.merge(
-        shipments_df,
-        merged_weather,
+    fact_df = shipments_df.join(
+        weather_indexed,
+        on=["start_location_key", "hourly_timestamp"],
         how="inner",
-        on=["city", "hourly_timestamp"]
+        sort=False
     )
 
-    if fact_df.empty:
-        logging.warning("No matching records found after join.")
-        return pd.DataFrame()
+    fact_df["city_id"] = fact_df["start_location_key"].map(city_to_id).astype("Int64")
+    # Nullable int keeps codes as "3", not "3.0", so COPY into BIGINT accepts them
+    fact_df["weathercode"] = fact_df["weathercode"].astype("Int64")
 
-    result_df = fact_df[[
-        "id_x",  # shipment_id
-        "id_y",  # city_id
+    return fact_df[[
+        "id",  # shipment_id
+        "city_id",
         "shipment_start_timestamp",
         "consumed_fuel",
         "temperature_2m",
@@ -133,30 +186,143 @@ def preprocess_and_join(shipments_df, cities_df, weather_df):
         "precipitation",
         "weathercode"
     ]].rename(columns={
-        "id_x": "shipment_id",
-        "id_y": "city_id",
+        "id": "shipment_id",
         "shipment_start_timestamp": "timestamp",
         "consumed_fuel": "fuel_consumed_liters"
     })
 
-    logging.info(f"Final fact table shape: {result_df.shape}")
-    return result_df
+
+# -------------------------------------------------------------------
+# Database-side Join
+# -------------------------------------------------------------------
+
+def stage_weather_in_postgres(conn, weather_df):
+    """
+    Copies weather data into a stg_weather temp table that is dropped when the
+    surrounding transaction commits or rolls back.
+    """
+    conn.execute(text("""
+        CREATE TEMP TABLE stg_weather (
+            city_key TEXT,
+            latitude FLOAT,
+            longitude FLOAT,
+            timestamp TIMESTAMP,
+            temperature_2m FLOAT,
+            windspeed_10m FLOAT,
+            precipitation FLOAT,
+            weathercode BIGINT
+        ) ON COMMIT DROP;
+    """))
+
+    staged_df = weather_df[STG_WEATHER_COLUMNS].assign(
+        weathercode=weather_df["weathercode"].astype("Int64")
+    )
+    buf = io.StringIO()
+    staged_df.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+
+    with conn.connection.cursor() as cur:
+        cur.copy_expert(
+            f"COPY stg_weather ({', '.join(STG_WEATHER_COLUMNS)}) FROM STDIN WITH CSV",
+            buf
+        )
+
+    # Index after the COPY so the bulk load does not maintain it row by row
+    conn.execute(text("CREATE INDEX ON stg_weather (city_key, timestamp);"))
+    conn.execute(text("ANALYZE stg_weather;"))
+    logging.info(f"Staged {len(staged_df)} weather records in stg_weather.")
+
+
+def build_fact_table_in_postgres(weather_df):
+    """
+    Stages weather data and builds the fact table with a single INSERT ... SELECT,
+    so shipments and cities never leave the database.
+    """
+    if weather_df.empty:
+        logging.warning("Weather dataset is empty. Database join skipped.")
+        return
+
+    try:
+        engine = get_sqlalchemy_engine()
+        with engine.begin() as conn:
+            conn.execute(text("CREATE SCHEMA IF NOT EXISTS analytics;"))
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS analytics.fact_shipments_weather (
+                    shipment_id BIGINT,
+                    city_id BIGINT,
+                    timestamp TIMESTAMP,
+                    fuel_consumed_liters FLOAT,
+                    temperature_2m FLOAT,
+                    windspeed_10m FLOAT,
+                    precipitation FLOAT,
+                    weathercode BIGINT
+                );
+            """))
+
+            stage_weather_in_postgres(conn, weather_df)
+
+            result = conn.execute(text("""
+                INSERT INTO analytics.fact_shipments_weather (
+                    shipment_id, city_id, timestamp, fuel_consumed_liters,
+                    temperature_2m, windspeed_10m, precipitation, weathercode
+                )
+                SELECT
+                    s.id,
+                    c.id,
+                    s.shipment_start_timestamp,
+                    s.consumed_fuel,
+                    w.temperature_2m,
+                    w.windspeed_10m,
+                    w.precipitation,
+                    w.weathercode
+                FROM shipments.shipments s
+                JOIN shipments.cities c
+                    ON c.city_key = lower(trim(s.start_location))
+                JOIN stg_weather w
+                    ON w.city_key = c.city_key
+                    AND w.timestamp = date_trunc('hour', s.shipment_start_timestamp)
+                WHERE s.shipment_start_timestamp >= :start_date
+                  AND s.shipment_start_timestamp < :end_date;
+            """), {"start_date": START_DATE, "end_date": END_DATE_EXCLUSIVE})
+
+        logging.info(f"Inserted {result.rowcount} rows into analytics.fact_shipments_weather.")
+    except (SQLAlchemyError, psycopg2.Error) as e:
+        # The raw COPY raises psycopg2 errors; re-raise both so main never reports success
+        logging.error(f"Database join error: {e}")
+        raise
 
 
 # -------------------------------------------------------------------
 # Output Writer
 # -------------------------------------------------------------------
 
-def write_fact_table_to_csv(df):
-    """Writes the fact table to a CSV file."""
-    if df.empty:
-        logging.warning("Fact table is empty. CSV write skipped.")
+def write_fact_table_to_csv(fact_chunks):
+    """
+    Writes fact table chunks to a temporary CSV as they are produced and
+    moves it into place only once every chunk has been written.
+    """
+    os.makedirs("data/processed", exist_ok=True)
+    output_path = FACT_CSV_PATH
+    tmp_path = f"{output_path}.tmp"
+
+    row_count = 0
+    try:
+        for df in fact_chunks:
+            if df.empty:
+                continue
+            df.to_csv(tmp_path, mode="w" if row_count == 0 else "a", header=row_count == 0, index=False)
+            row_count += len(df)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    if row_count == 0:
+        logging.warning("No matching records found after join. CSV write skipped.")
         return
 
-    os.makedirs("data/processed", exist_ok=True)
-    output_path = "data/processed/fact_shipments_weather.csv"
-    df.to_csv(output_path, index=False)
-    logging.info(f"Fact table written to: {output_path}")
+    os.replace(tmp_path, output_path)
+    logging.info(f"Fact table written to: {output_path} ({row_count} rows)")
 
 
 # -------------------------------------------------------------------
@@ -166,11 +332,30 @@ def write_fact_table_to_csv(df):
 def main():
     logging.info("ETL pipeline started.")
 
-    shipments_df, cities_df = load_shipments_and_cities()
-    weather_df = load_weather_csv(WEATHER_CSV_PATH)
-
-    final_df = preprocess_and_join(shipments_df, cities_df, weather_df)
-    write_fact_table_to_csv(final_df)
+    if FACT_JOIN_MODE not in FACT_JOIN_MODES:
+        logging.error(f"Unknown FACT_JOIN_MODE: {FACT_JOIN_MODE!r}")
+        raise ValueError(f"FACT_JOIN_MODE must be one of {sorted(FACT_JOIN_MODES)}, got {FACT_JOIN_MODE!r}")
+
+    weather_df = load_weather_parquet(WEATHER_PARQUET_PATH)
+
+    if FACT_JOIN_MODE == "database":
+        # The fact rows land in PostgreSQL directly; drop any earlier CSV so the
+        # load step cannot COPY stale rows on top of them
+        if os.path.exists(FACT_CSV_PATH):
+            os.remove(FACT_CSV_PATH)
+            logging.info(f"Removed stale fact CSV: {FACT_CSV_PATH}")
+        build_fact_table_in_postgres(weather_df)
+    else:
+        weather_indexed, city_to_id = prepare_weather(load_cities(), weather_df)
+        if weather_indexed.empty:
+            logging.warning("No weather to join against. Fact build skipped.")
+            return
+
+        fact_chunks = (
+            join_shipments_with_weather(shipments_df, weather_indexed, city_to_id)
+            for shipments_df in iter_shipment_chunks()
+        )
+        write_fact_table_to_csv(fact_chunks)
 
     logging.info("ETL pipeline completed successfully.")
 